@@ -1,13 +1,27 @@
+import hashlib
+import json
 import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import closing
 from io import BytesIO
-from typing import List
+from typing import Callable, Iterator, List, Optional, Tuple, TypeVar
 
+import numpy as np
 import streamlit as st
 import pandas as pd
-from PyPDF2 import PdfReader
+import requests
 from gtts import gTTS
+from pydub import AudioSegment
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+
+from pdf_extract import extract_pdf_text
 
 
 # --------------------------
@@ -33,13 +47,54 @@ LANG_CHOICES = {
 }
 
 MODEL_NAME = "gemini-1.5-flash"
-TEMPERATURE = 0.2
-MAX_CHARS_PER_CHUNK = 4500  # conservative; Gemini can handle more, but chunking is safer
+TEMPERATURE = 0  # deterministic output, so identical inputs can hit response caches
+OUTPUT_TOKENS_PER_CHAR = 3  # generous ceiling on translation length, relative to the source chunk
+MIN_OUTPUT_TOKENS = 32
+DEFAULT_OUTPUT_TOKEN_LIMIT = 8192  # gemini-1.5-flash; used if the model metadata can't be fetched
+MAX_CHARS_PER_CHUNK = 4500  # chunk size if token counting fails
+MAX_TOKENS_PER_CHUNK = 3000  # input tokens per chunk; chunk sizes are derived from this
+# Translations into other scripts can take several times the source's tokens, so chunks are
+# also kept to output_token_limit / this, leaving room for the whole translation
+OUTPUT_TOKENS_PER_INPUT_TOKEN = 3
+TOKEN_SAMPLE_CHARS = 20000  # characters sampled to measure the text's token density
+TOKEN_SAMPLE_WINDOWS = 10  # the sample is taken as this many windows spread across the text
+LINE_DEDUP_MAX_UNIQUE_RATIO = 0.5  # translate line by line when at most this share of lines is distinct
+# Chunk boundaries: a sentence terminator followed by whitespace, a CJK/Devanagari full stop
+# (3 bytes in UTF-8, usually not followed by whitespace), or a paragraph break. Line breaks and
+# other whitespace are only looked for inside a window that has none of these.
+_WIDE_STOPS = [t.encode("utf-8") for t in "。！？।"]
+_WHITESPACE = b" \t\n\r\f\v"
+_WHITESPACE_RE = re.compile(rb"\s")
+MAX_CONCURRENT_REQUESTS = 8  # parallel Gemini calls per translation; keeps us under RPM limits
+RETRY_ATTEMPTS = 5  # tries per request when Gemini answers 429 (quota exhausted)
+RETRY_BASE_SECONDS = 2  # first backoff delay; doubles on each retry
+# Short strings (table cells, distinct lines) are sent as JSON arrays of up to this size per request
+PACK_MAX_ITEMS = 100
+PACK_MAX_BYTES = MAX_CHARS_PER_CHUNK
+BATCH_THRESHOLD_BYTES = 200_000  # total input size; below this, parallel sync calls finish sooner
+BATCH_POLL_MAX_SECONDS = 60  # cap for the exponential backoff between batch status checks
+BATCH_WAIT_SECONDS = 30  # how long one click waits on a batch job; a later click collects it if still running
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+
+# Parsed uploads are held in server memory and shared by all sessions, so keep them few and short-lived
+UPLOAD_CACHE_MAX_ENTRIES = 16
+UPLOAD_CACHE_TTL_SECONDS = 30 * 60
+
+CACHE_PATH = os.path.join(".cache", "translations.sqlite3")
+CACHE_MAX_ENTRIES = 10000
+
+# Streaming TTS: the first segment is short so audio starts early, later ones grow up to the cap
+TTS_FIRST_SEGMENT_CHARS = 20
+TTS_MAX_SEGMENT_CHARS = 200
+OPUS_BITRATE = "24k"  # speech stays clear at this rate; roughly half the size of gTTS's MP3
+# CJK full stops are usually not followed by whitespace, so split right after them
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?।])\s+|(?<=[。！？])")
 
 
 # --------------------------
 # Secrets / API key helpers
 # --------------------------
+@st.cache_data(show_spinner=False)
 def get_gemini_api_key() -> str:
     """
     Priority:
@@ -65,113 +120,788 @@ def get_gemini_api_key() -> str:
     return key
 
 
-def get_model():
-    genai.configure(api_key=get_gemini_api_key())
-    return genai.GenerativeModel(MODEL_NAME)
+def _system_instruction(target_language_name: str) -> str:
+    return (
+        f"You are a translator. Translate the user's English text into {target_language_name}.\n"
+        f"Return only the translation, with no extra commentary or quotation marks.\n"
+        f"If the input is a JSON array of strings, translate each string separately and return "
+        f"a JSON array of the same length and order."
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_model(target_language_name: str):
+    """Build one model per target language, once per process rather than on every rerun.
+
+    The instruction lives in the system prompt so every request for a language
+    shares the same prefix and only the chunk itself varies.
+    """
+    _configure_client()
+    return genai.GenerativeModel(MODEL_NAME, system_instruction=_system_instruction(target_language_name))
+
+
+@st.cache_resource(show_spinner=False)
+def _configure_client() -> None:
+    """Configure the Gemini client once per process; reconfiguring drops its open channels."""
+    genai.configure(api_key=get_gemini_api_key(), transport="grpc")
+
+
+@st.cache_resource(show_spinner=False)
+def _warm_up_client() -> None:
+    """Open the gRPC channel in the background when the app loads, off the translate click path.
+
+    ``count_tokens`` isn't billed and goes through the same client as
+    ``generate_content``, so the first translation reuses an already-open channel.
+    """
+    try:
+        _configure_client()
+    except RuntimeError:
+        return  # no API key yet; the translate path reports it
+
+    def warm() -> None:
+        try:
+            genai.GenerativeModel(MODEL_NAME).count_tokens("ok")
+        except Exception:
+            pass
+
+    threading.Thread(target=warm, daemon=True).start()
+
+
+@st.cache_resource(show_spinner=False)
+def _output_token_limit() -> int:
+    """Return the model's maximum output tokens (looked up once per process)."""
+    try:
+        return genai.get_model(f"models/{MODEL_NAME}").output_token_limit
+    except Exception:
+        return DEFAULT_OUTPUT_TOKEN_LIMIT
+
+
+# --------------------------
+# Translation cache
+# --------------------------
+def _cache_scope(target_language_name: str) -> str:
+    """Identify the model, prompt and sampling settings a cached translation came from.
+
+    Changing any of them starts a fresh scope, so stale entries are never served.
+    """
+    settings = f"{MODEL_NAME}\0{TEMPERATURE}\0{_system_instruction(target_language_name)}"
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+
+def _cache_key(chunk: str, scope: str) -> str:
+    """Key a chunk by its text with spacing normalised.
+
+    Chunks that differ only in runs of spaces, indentation or trailing
+    whitespace share an entry, since they translate the same; line breaks
+    and every other character, case included, still have to match exactly.
+    """
+    return hashlib.sha256(f"{scope}\0{_normalise_source(chunk)}".encode("utf-8")).hexdigest()
+
+
+def _normalise_source(text: str) -> str:
+    return "\n".join(" ".join(line.split()) for line in text.strip().splitlines())
+
+
+def _open_cache() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(CACHE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT NOT NULL)")
+    # Batch jobs still running, so a reload or restart collects them instead of submitting again
+    conn.execute("CREATE TABLE IF NOT EXISTS batch_jobs (key TEXT PRIMARY KEY, job_name TEXT NOT NULL)")
+    return conn
+
+
+def _cache_lookup(conn: sqlite3.Connection, chunks: List[str], target_language_name: str) -> List[Optional[str]]:
+    """Return the cached translation (or None) for each chunk."""
+    scope = _cache_scope(target_language_name)
+    results: List[Optional[str]] = []
+    for chunk in chunks:
+        row = conn.execute(
+            "SELECT translation FROM translations WHERE key = ?",
+            (_cache_key(chunk, scope),),
+        ).fetchone()
+        results.append(row[0] if row else None)
+    return results
+
+
+def _cache_store(
+    conn: sqlite3.Connection, chunks: List[str], target_language_name: str, translations: List[str]
+) -> None:
+    scope = _cache_scope(target_language_name)
+    rows = [
+        (_cache_key(chunk, scope), translation)
+        for chunk, translation in zip(chunks, translations)
+        if translation
+    ]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?)", rows)
+        # Keep only the most recently written entries
+        conn.execute(
+            "DELETE FROM translations WHERE rowid IN ("
+            " SELECT rowid FROM translations ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+            (CACHE_MAX_ENTRIES,),
+        )
 
 
 # --------------------------
 # Text utilities
 # --------------------------
+def _last_boundary(bounds: np.ndarray, start: int, limit: int) -> Optional[int]:
+    """Return the last boundary in (start, limit], or None."""
+    i = int(np.searchsorted(bounds, limit, side="right")) - 1
+    if i >= 0 and bounds[i] > start:
+        return int(bounds[i])
+    return None
+
+
+def _last_whitespace(data: bytes, start: int, limit: int, chars: bytes = _WHITESPACE) -> Optional[int]:
+    """Return the offset just past the last of chars in data[start:limit], or None."""
+    pos = max(data.rfind(c, start, limit) for c in chars)
+    return pos + 1 if pos >= 0 else None
+
+
+def _positions(arr: np.ndarray, values: bytes) -> np.ndarray:
+    """Return the sorted indices of arr holding any of the given byte values."""
+    mask = arr == values[0]
+    for v in values[1:]:
+        mask |= arr == v
+    return np.flatnonzero(mask)
+
+
+def _find_boundaries(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Return sorted offsets just past every sentence/paragraph boundary, and past paragraph breaks alone.
+
+    One vectorised comparison pass finds the candidate bytes (newlines,
+    terminators, lead bytes of the wide stops); the bytes after them are then
+    checked only at those few positions. All boundaries end on ASCII or a
+    complete 3-byte character, so slicing there is UTF-8 safe.
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    nl = _positions(arr[:-1], b"\n")
+    para_ends = nl[arr[nl + 1] == 0x0A] + 2
+    stops = _positions(arr[:-1], b".!?")
+    ends = [para_ends, stops[np.isin(arr[stops + 1], np.frombuffer(_WHITESPACE, dtype=np.uint8))] + 1]
+    leads = _positions(arr[:-2], bytes({stop[0] for stop in _WIDE_STOPS}))
+    for b0, b1, b2 in _WIDE_STOPS:
+        ends.append(leads[(arr[leads] == b0) & (arr[leads + 1] == b1) & (arr[leads + 2] == b2)] + 3)
+    return np.sort(np.concatenate(ends)), para_ends
+
+
 def _split_text(text: str, max_chars: int = MAX_CHARS_PER_CHUNK) -> List[str]:
-    """Split long text into (roughly) sentence/paragraph chunks under max_chars."""
-    if len(text) <= max_chars:
+    """Split long text into (roughly) sentence/paragraph chunks under max_chars UTF-8 bytes.
+
+    Paragraph and sentence boundaries are found in one vectorised scan of the
+    UTF-8 bytes, then chunks are packed greedily by binary search over those
+    offsets. Each chunk ends at the strongest boundary that leaves it at least
+    half full: a paragraph, a sentence, a line break, then any whitespace, so a
+    chunk only exceeds max_chars when it contains no whitespace at all. Sizes are counted in bytes, which matches characters for
+    English input.
+    """
+    data = text.encode("utf-8")
+    if len(data) <= max_chars:
         return [text]
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n")
+
+    all_ends, para_ends = _find_boundaries(data)
+    chunks = []
+    start, size = 0, len(data)
+    while size - start > max_chars:
+        limit, floor = start + max_chars, start + max_chars // 2
+        # Take the strongest boundary that leaves the chunk at least half full
+        end = _last_boundary(para_ends, floor, limit)
+        if end is None:
+            end = _last_boundary(all_ends, floor, limit)
+        if end is None:
+            end = _last_whitespace(data, floor, limit, b"\n")
+        # Otherwise any whitespace, then a CJK stop, wherever it falls in the window
+        if end is None:
+            end = _last_whitespace(data, start, limit)
+        if end is None:
+            end = _last_boundary(all_ends, start, limit)
+        if end is None:
+            # No whitespace in range: keep the oversized run whole up to the next whitespace
+            m = _WHITESPACE_RE.search(data, limit)
+            end = m.end() if m else size
+        chunk = data[start:end].decode("utf-8").strip()
+        if chunk:
+            chunks.append(chunk)
+        start = end
+
+    tail = data[start:].decode("utf-8").strip()
+    if tail:
+        chunks.append(tail)
+    return chunks
 
-    chunks, current = [], []
-    total = 0
-    # Prefer splitting on double newlines or periods
-    units = [u for u in text.replace("\r\n", "\n").split("\n\n") if u.strip()]
-    for block in units:
-        if len(block) > max_chars:
-            # fallback: split by sentences if a block is too big
-            sentences = [s.strip() for s in block.split(". ") if s.strip()]
-            for s in sentences:
-                s2 = s if s.endswith(".") else s + "."
-                if total + len(s2) > max_chars and current:
-                    chunks.append(" ".join(current))
-                    current, total = [], 0
-                current.append(s2)
-                total += len(s2)
-        else:
-            if total + len(block) + 2 > max_chars and current:
-                chunks.append("\n\n".join(current))
-                current, total = [], 0
-            current.append(block)
-            total += len(block) + 2
 
-    if current:
-        # join with paragraph breaks
-        chunks.append("\n\n".join(current))
-    return chunks
+def _generation_config(chunk: str, output_limit: int) -> dict:
+    # snake_case keys are accepted by both the SDK and the REST batch endpoint
+    max_tokens = max(int(len(chunk) * OUTPUT_TOKENS_PER_CHAR), MIN_OUTPUT_TOKENS)
+    return {
+        "temperature": TEMPERATURE,
+        "top_p": 1,
+        "candidate_count": 1,
+        "max_output_tokens": min(max_tokens, output_limit),
+        "response_mime_type": "text/plain",
+    }
+
 
+class TranslationTruncated(RuntimeError):
+    """Gemini stopped at its output token limit before finishing a translation."""
 
-def translate_text(model, text: str, target_language_name: str) -> str:
-    """Translate text using Gemini with clear, deterministic instructions."""
-    chunks = _split_text(text, MAX_CHARS_PER_CHUNK)
-    outputs = []
-    for idx, chunk in enumerate(chunks, start=1):
-        prompt = (
-            f"Translate the following English text into {target_language_name}.\n"
-            f"Return only the translation, with no extra commentary or quotation marks.\n\n"
-            f"{chunk}"
+
+def _is_truncated(finish_reason) -> bool:
+    return finish_reason in (genai.protos.Candidate.FinishReason.MAX_TOKENS, "MAX_TOKENS")
+
+
+def _generate_with_retry(model, contents: str, generation_config: dict, stream: bool = False):
+    """Call generate_content, backing off exponentially while the quota is exhausted (429).
+
+    With ``stream=True`` the first event is fetched before the response is
+    returned, so a 429 surfaces here, before any text has been yielded.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return model.generate_content(contents, generation_config=generation_config, stream=stream)
+        except ResourceExhausted:
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(RETRY_BASE_SECONDS * 2**attempt)
+
+
+def _translate_chunk(model, chunk: str, output_limit: int) -> str:
+    resp = _generate_with_retry(model, chunk, _generation_config(chunk, output_limit))
+    if resp.candidates and _is_truncated(resp.candidates[0].finish_reason):
+        return _translate_in_halves(model, chunk, output_limit)
+    return (resp.text or "").strip()
+
+
+def _translate_in_halves(model, chunk: str, output_limit: int) -> str:
+    """Retry a chunk whose translation hit the output limit as two smaller ones."""
+    pieces = _split_text(chunk, len(chunk.encode("utf-8")) // 2)
+    if len(pieces) < 2:
+        raise TranslationTruncated(
+            "Gemini stopped at its output token limit on a passage with no whitespace to split at."
         )
-        resp = model.generate_content(
-            prompt,
-            generation_config={"temperature": TEMPERATURE},
+    return "\n\n".join(_translate_chunk(model, piece, output_limit) for piece in pieces)
+
+
+class BatchPending(RuntimeError):
+    """A Batch API job is still running; translating the same input again collects its result."""
+
+
+def _batch_job_key(chunks: List[str], target_language_name: str) -> str:
+    digest = hashlib.sha256(_cache_scope(target_language_name).encode("utf-8"))
+    for chunk in chunks:
+        digest.update(b"\0" + chunk.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _pending_batch_job(job_key: str) -> Optional[str]:
+    with closing(_open_cache()) as conn:
+        row = conn.execute("SELECT job_name FROM batch_jobs WHERE key = ?", (job_key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_batch_job(job_key: str, job_name: Optional[str]) -> None:
+    """Record the job running for job_key, or forget it when job_name is None."""
+    with closing(_open_cache()) as conn, conn:
+        if job_name is None:
+            conn.execute("DELETE FROM batch_jobs WHERE key = ?", (job_key,))
+        else:
+            conn.execute("INSERT OR REPLACE INTO batch_jobs VALUES (?, ?)", (job_key, job_name))
+
+
+def _translate_batch(model, chunks: List[str], target_language_name: str) -> List[str]:
+    """Submit all chunks as one Gemini Batch API job and return the translations in order.
+
+    Each request carries its chunk index as ``metadata.key`` so the inlined
+    responses can be reassembled regardless of the order the server returns them.
+    Batch jobs may sit in the queue for hours, so a click only waits
+    ``BATCH_WAIT_SECONDS``. The job name is recorded in the on-disk cache and the
+    job left running: BatchPending is raised, and translating the same input
+    again, even after a reload or restart, picks the job up instead of paying
+    for the work twice.
+    """
+    headers = {"x-goog-api-key": get_gemini_api_key()}
+    output_limit = _output_token_limit()
+    job_key = _batch_job_key(chunks, target_language_name)
+    job_name = _pending_batch_job(job_key)
+    if job_name is None:
+        batch_requests = [
+            {
+                "request": {
+                    "system_instruction": {"parts": [{"text": _system_instruction(target_language_name)}]},
+                    "contents": [{"role": "user", "parts": [{"text": chunk}]}],
+                    "generationConfig": _generation_config(chunk, output_limit),
+                },
+                "metadata": {"key": str(idx)},
+            }
+            for idx, chunk in enumerate(chunks)
+        ]
+        body = {
+            "batch": {
+                "display_name": "text-translator",
+                "input_config": {"requests": {"requests": batch_requests}},
+            }
+        }
+        resp = requests.post(
+            f"{GEMINI_API_BASE}/{model.model_name}:batchGenerateContent",
+            json=body,
+            headers=headers,
+            timeout=60,
         )
-        outputs.append((resp.text or "").strip())
-    return "\n\n".join(outputs).strip()
+        resp.raise_for_status()
+        job_name = resp.json()["name"]
+        _set_batch_job(job_key, job_name)
+
+    progress = st.progress(0.0, text="Batch job running...")
+    deadline = time.monotonic() + BATCH_WAIT_SECONDS
+    delay = 2.0
+    while True:
+        resp = requests.get(f"{GEMINI_API_BASE}/{job_name}", headers=headers, timeout=60)
+        if resp.status_code == 404:
+            _set_batch_job(job_key, None)  # expired server-side; the next click submits a new job
+        resp.raise_for_status()
+        job = resp.json()
+        meta = job.get("metadata", {})
+        state = meta.get("state", "")
+        if job.get("done"):
+            break
+        stats = meta.get("batchStats", {})
+        finished = int(stats.get("successfulRequestCount", 0)) + int(stats.get("failedRequestCount", 0))
+        progress.progress(min(finished / len(chunks), 1.0), text=f"Batch job: {finished}/{len(chunks)} chunks")
+        if time.monotonic() + delay > deadline:
+            progress.empty()
+            raise BatchPending(
+                f"The batch job is still running ({finished}/{len(chunks)} chunks done). "
+                "Click Translate again later to collect the result."
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+    progress.empty()
+    _set_batch_job(job_key, None)
+
+    if state != "BATCH_STATE_SUCCEEDED" or "error" in job:
+        raise RuntimeError(f"Gemini batch job did not succeed (state: {state or 'unknown'}).")
+
+    outputs = [""] * len(chunks)
+    truncated = []
+    inlined = job["response"]["inlinedResponses"]["inlinedResponses"]
+    for pos, item in enumerate(inlined):
+        idx = int(item.get("metadata", {}).get("key", pos))
+        if "error" in item:
+            raise RuntimeError(f"Chunk {idx + 1} failed in batch job: {item['error'].get('message', '')}")
+        candidate = item["response"]["candidates"][0]
+        if _is_truncated(candidate.get("finishReason")):
+            truncated.append(idx)
+            continue
+        parts = candidate["content"]["parts"]
+        outputs[idx] = "".join(p.get("text", "") for p in parts).strip()
+
+    # Redo the few chunks that hit the output limit as smaller synchronous requests
+    redone = _run_concurrently(lambda i: _translate_in_halves(model, chunks[i], output_limit), truncated)
+    for idx, translation in zip(truncated, redone):
+        outputs[idx] = translation
+    return outputs
+
+
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
+
+def _run_concurrently(fn: Callable[[_T], _R], items: List[_T]) -> List[_R]:
+    """Apply fn to items on a thread pool and return the results in input order.
+
+    On the first failure the queued calls are cancelled before re-raising, so a
+    single 429 doesn't leave the rest of the document being sent (and billed).
+    """
+    pool = ThreadPoolExecutor(max_workers=max(min(MAX_CONCURRENT_REQUESTS, len(items)), 1))
+    futures = [pool.submit(fn, item) for item in items]
+    try:
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+        return [future.result() for future in futures]
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _translate_concurrently(model, chunks: List[str]) -> List[str]:
+    # Resolved here, on the script thread, rather than inside the workers
+    output_limit = _output_token_limit()
+    return _run_concurrently(lambda c: _translate_chunk(model, c, output_limit), chunks)
+
+
+def _translate_chunks(model, chunks: List[str], target_language_name: str) -> List[str]:
+    """Translate chunks with Gemini, returning the translations in input order."""
+    if len(chunks) == 1:
+        return [_translate_chunk(model, chunks[0], _output_token_limit())]
+
+    if sum(len(c.encode("utf-8")) for c in chunks) >= BATCH_THRESHOLD_BYTES:
+        return _translate_batch(model, chunks, target_language_name)
+
+    return _translate_concurrently(model, chunks)
+
+
+def _pack_strings(strings: List[str]) -> List[List[str]]:
+    packs, current, size = [], [], 0
+    for text in strings:
+        n = len(text.encode("utf-8"))
+        if current and (size + n > PACK_MAX_BYTES or len(current) >= PACK_MAX_ITEMS):
+            packs.append(current)
+            current, size = [], 0
+        current.append(text)
+        size += n
+    if current:
+        packs.append(current)
+    return packs
+
+
+def _translate_pack(model, strings: List[str], output_limit: int) -> List[str]:
+    """Translate several short strings in one request, sent and returned as a JSON array.
+
+    If the reply is truncated, unparseable or the wrong length, the pack is
+    halved and retried, down to single strings sent as plain text.
+    """
+    if len(strings) == 1:
+        return [_translate_chunk(model, strings[0], output_limit)]
+
+    payload = json.dumps(strings, ensure_ascii=False)
+    config = {
+        **_generation_config(payload, output_limit),
+        "response_mime_type": "application/json",
+        "response_schema": list[str],
+    }
+    resp = _generate_with_retry(model, payload, config)
+    if resp.candidates and not _is_truncated(resp.candidates[0].finish_reason):
+        try:
+            parsed = json.loads(resp.text)
+        except ValueError:
+            parsed = None
+        if isinstance(parsed, list) and len(parsed) == len(strings) and all(isinstance(t, str) for t in parsed):
+            return [t.strip() for t in parsed]
+
+    mid = len(strings) // 2
+    return _translate_pack(model, strings[:mid], output_limit) + _translate_pack(model, strings[mid:], output_limit)
+
+
+def _translate_packed(model, strings: List[str]) -> List[str]:
+    output_limit = _output_token_limit()
+    packs = _run_concurrently(lambda pack: _translate_pack(model, pack, output_limit), _pack_strings(strings))
+    return [translation for pack in packs for translation in pack]
+
+
+def _translate_cached(
+    texts: List[str], target_language_name: str, translate_missing: Callable[[List[str]], List[str]]
+) -> List[str]:
+    """Serve texts from the translation cache, translating and storing only the misses."""
+    with closing(_open_cache()) as conn:
+        outputs = _cache_lookup(conn, texts, target_language_name)
+        missing = [i for i, out in enumerate(outputs) if out is None]
+        if missing:
+            todo = [texts[i] for i in missing]
+            fresh = translate_missing(todo)
+            for i, translation in zip(missing, fresh):
+                outputs[i] = translation
+            _cache_store(conn, todo, target_language_name, fresh)
+    return outputs
+
+
+def batch_translate(model, texts: List[str], target_language_name: str) -> List[str]:
+    """Translate each string independently, returning the translations in input order.
+
+    Strings already in the translation cache (up to spacing) skip the
+    model. The rest are sent concurrently; the calls are network-bound, so wall
+    time is roughly the slowest request rather than the sum of all of them.
+    Inputs of ``BATCH_THRESHOLD_BYTES`` or more go through the Batch API instead,
+    and raise BatchPending if the job hasn't finished yet.
+    """
+    return _translate_cached(
+        texts, target_language_name, lambda todo: _translate_chunks(model, todo, target_language_name)
+    )
+
+
+def translate_strings(model, strings: List[str], target_language_name: str) -> List[str]:
+    """Translate many short strings (table cells, distinct lines) in input order.
+
+    Cache misses are packed into JSON-array requests of up to ``PACK_MAX_ITEMS``
+    strings, so a table with thousands of distinct cells costs tens of requests.
+    """
+    return _translate_cached(strings, target_language_name, lambda todo: _translate_packed(model, todo))
+
+
+def _token_sample(text: str) -> str:
+    """Return up to TOKEN_SAMPLE_CHARS of text, taken as evenly spaced windows across all of it."""
+    if len(text) <= TOKEN_SAMPLE_CHARS:
+        return text
+    width = TOKEN_SAMPLE_CHARS // TOKEN_SAMPLE_WINDOWS
+    step = (len(text) - width) / (TOKEN_SAMPLE_WINDOWS - 1)
+    return "".join(text[int(i * step) : int(i * step) + width] for i in range(TOKEN_SAMPLE_WINDOWS))
+
+
+def _chunk_budget(model, text: str) -> int:
+    """Return the chunk size (in UTF-8 bytes) that holds about MAX_TOKENS_PER_CHUNK tokens.
+
+    The token target is lowered further if needed so a chunk's translation fits
+    in the model's output limit. A single count_tokens call on windows sampled
+    across the text measures how densely it tokenizes, so Latin text gets large
+    chunks and CJK text smaller ones. The budget uses the average density: in a
+    document that mixes scripts, chunks from its denser parts can still exceed
+    the token target, and a translation cut off by the output limit is split
+    and retried.
+    """
+    max_tokens = min(MAX_TOKENS_PER_CHUNK, _output_token_limit() // OUTPUT_TOKENS_PER_INPUT_TOKEN)
+    size = len(text.encode("utf-8"))
+    if size <= max_tokens:
+        # Every token covers at least one byte, so the whole text already fits
+        return size
+    sample = _token_sample(text)
+    try:
+        tokens = model.count_tokens(sample).total_tokens
+    except Exception:
+        return MAX_CHARS_PER_CHUNK
+    bytes_per_token = len(sample.encode("utf-8")) / max(tokens, 1)
+    return max(int(max_tokens * bytes_per_token), 1)
+
+
+def split_for_translation(model, text: str) -> List[str]:
+    """Split text into chunks sized for one translation request each."""
+    return _split_text(text, _chunk_budget(model, text))
+
+
+def translate_text(model, text: str, target_language_name: str, chunks: Optional[List[str]] = None) -> str:
+    """Translate text using Gemini with clear, deterministic instructions.
+
+    Highly repetitive text (logs, catalogs, forms) is translated as its distinct
+    lines, packed several to a request, and rebuilt from those, so duplicate
+    lines cost nothing. That path is only taken when it needs no more requests
+    than translating the text in chunks. Pass ``chunks`` from
+    ``split_for_translation`` if the caller already split the text, to avoid
+    measuring it again.
+    """
+    if chunks is None:
+        chunks = split_for_translation(model, text)
+    lines = text.splitlines()
+    content = [line for line in lines if line.strip()]
+    unique = list(dict.fromkeys(content))
+    if (
+        len(content) > 1
+        and len(unique) <= len(content) * LINE_DEDUP_MAX_UNIQUE_RATIO
+        and len(_pack_strings(unique)) <= len(chunks)
+    ):
+        translations = dict(zip(unique, translate_strings(model, unique, target_language_name)))
+        return "\n".join(translations.get(line, line) for line in lines).strip()
+
+    return "\n\n".join(batch_translate(model, chunks, target_language_name)).strip()
+
+
+def translate_table(model, df: pd.DataFrame, target_language_name: str) -> str:
+    """Translate the text cells and headers of a table and return it as CSV.
+
+    Works column-wise on unique values: repeated categories are translated
+    once and mapped back, and the column structure is preserved.
+    """
+    text_cols = df.select_dtypes(include=["object", "string"]).columns
+    values = pd.unique(np.concatenate([df[text_cols].to_numpy().ravel(), df.columns.to_numpy()]))
+    uniques = [v for v in values if isinstance(v, str) and v.strip()]
+    translations = dict(zip(uniques, translate_strings(model, uniques, target_language_name)))
+
+    out = df.copy()
+    for col in text_cols:
+        out[col] = out[col].map(lambda v: translations.get(v, v))
+    out.columns = [translations.get(c, c) if isinstance(c, str) else c for c in df.columns]
+    return out.to_csv(index=False)
+
+
+def stream_translation(model, text: str, target_language_name: str) -> Iterator[str]:
+    """Yield the translation of a single-chunk text as Gemini streams it back.
+
+    Raises TranslationTruncated if the output limit cut the stream short; the
+    caller should discard what was shown and fall back to ``translate_text``.
+    """
+    with closing(_open_cache()) as conn:
+        (cached,) = _cache_lookup(conn, [text], target_language_name)
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        response = _generate_with_retry(model, text, _generation_config(text, _output_token_limit()), stream=True)
+        for event in response:
+            piece = event.text or ""
+            parts.append(piece)
+            yield piece
+        if response.candidates and _is_truncated(response.candidates[0].finish_reason):
+            raise TranslationTruncated("The streamed translation hit the output token limit.")
+        _cache_store(conn, [text], target_language_name, ["".join(parts).strip()])
 
 
 # --------------------------
 # File extraction
 # --------------------------
+def _hash_upload(uploaded: UploadedFile) -> str:
+    return hashlib.sha256(uploaded.getvalue()).hexdigest()
+
+
+# Streamlit reruns the script on every widget change; key parsed uploads by content
+# so the same file is only extracted once.
+@st.cache_data(
+    show_spinner=False,
+    hash_funcs={UploadedFile: _hash_upload},
+    max_entries=UPLOAD_CACHE_MAX_ENTRIES,
+    ttl=UPLOAD_CACHE_TTL_SECONDS,
+)
 def extract_text_from_file(uploaded) -> str:
     """Return extracted text or raise a ValueError with a friendly message."""
     mime = uploaded.type or ""
     name = uploaded.name.lower()
 
     if mime == "application/pdf" or name.endswith(".pdf"):
-        reader = PdfReader(uploaded)
-        pages = []
-        for p in reader.pages:
-            pages.append(p.extract_text() or "")
-        text = "\n\n".join(pages).strip()
+        text = extract_pdf_text(uploaded.getvalue()).strip()
         if not text:
             raise ValueError("No extractable text found. The PDF may be scanned; consider OCR.")
         return text
 
     if mime == "text/plain" or name.endswith(".txt"):
-        return uploaded.read().decode("utf-8", errors="ignore")
+        return uploaded.getvalue().decode("utf-8", errors="ignore")
+
+    raise ValueError("Unsupported file type. Please upload PDF, TXT, CSV, or XLSX.")
+
+
+@st.cache_data(
+    show_spinner=False,
+    hash_funcs={UploadedFile: _hash_upload},
+    max_entries=UPLOAD_CACHE_MAX_ENTRIES,
+    ttl=UPLOAD_CACHE_TTL_SECONDS,
+)
+def load_table(uploaded) -> Optional[pd.DataFrame]:
+    """Return CSV/XLS/XLSX uploads as a DataFrame, or None for other file types."""
+    mime = uploaded.type or ""
+    name = uploaded.name.lower()
 
     if mime in ("text/csv",) or name.endswith(".csv"):
-        df = pd.read_csv(uploaded)
-        return df.to_csv(index=False)
+        return pd.read_csv(uploaded)
 
     if mime in (
         "application/vnd.ms-excel",
         "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     ) or name.endswith((".xls", ".xlsx")):
-        df = pd.read_excel(uploaded)
-        # Represent as CSV text for translation (simple and readable)
-        return df.to_csv(index=False)
+        return pd.read_excel(uploaded)
 
-    raise ValueError("Unsupported file type. Please upload PDF, TXT, CSV, or XLSX.")
+    return None
 
 
 # --------------------------
 # Text-to-Speech
 # --------------------------
-def synthesize_speech(text: str, lang_code: str, out_path: str = "translated_audio.mp3") -> str:
-    tts = gTTS(text=text, lang=lang_code)
-    tts.save(out_path)
-    return out_path
+def _tts_to_bytes(text: str, lang_code: str) -> bytes:
+    buf = BytesIO()
+    gTTS(text=text, lang=lang_code).write_to_fp(buf)
+    return buf.getvalue()
+
+
+class SpeechStream:
+    """Synthesize speech for text that arrives incrementally.
+
+    Completed sentences are handed to background gTTS requests as soon as the
+    buffer passes the current segment size, so speech is mostly ready by the
+    time the translation finishes. Segment sizes start small and double up to
+    ``TTS_MAX_SEGMENT_CHARS``. MP3 frames concatenate cleanly, so the segments
+    are simply joined.
+    """
+
+    def __init__(self, lang_code: str):
+        self._lang_code = lang_code
+        self._pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+        self._futures = []
+        self._buffer = ""
+        self._segment_chars = TTS_FIRST_SEGMENT_CHARS
+
+    def feed(self, text: str) -> None:
+        self._buffer += text
+        while True:
+            cut = self._sentence_end(self._segment_chars)
+            if cut is None:
+                return
+            self._submit(self._buffer[:cut])
+            self._buffer = self._buffer[cut:]
+            self._segment_chars = min(self._segment_chars * 2, TTS_MAX_SEGMENT_CHARS)
+
+    def finish(self) -> bytes:
+        """Flush the remaining text and return the complete MP3."""
+        self._submit(self._buffer)
+        self._buffer = ""
+        try:
+            return b"".join(f.result() for f in self._futures)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stop the worker threads, dropping any segments not yet synthesized."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _sentence_end(self, min_chars: int) -> Optional[int]:
+        # Same boundaries as synthesize_speech, so "3.14", "e.g." or URLs aren't cut mid-token
+        match = _SENTENCE_SPLIT_RE.search(self._buffer, min_chars)
+        return match.start() if match else None
+
+    def _submit(self, segment: str) -> None:
+        if segment.strip():
+            self._futures.append(self._pool.submit(_tts_to_bytes, segment.strip(), self._lang_code))
+
+
+def synthesize_speech(text: str, lang_code: str) -> bytes:
+    """Synthesize text as MP3 bytes, running the gTTS requests for each segment in parallel."""
+    segments, current = [], ""
+    for sentence in _SENTENCE_SPLIT_RE.split(text):
+        if current and len(current) + len(sentence) > TTS_MAX_SEGMENT_CHARS:
+            segments.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+    if current.strip():
+        segments.append(current)
+
+    parts = _run_concurrently(lambda seg: _tts_to_bytes(seg, lang_code), segments)
+    return b"".join(parts)
+
+
+def to_opus(mp3_bytes: bytes) -> Optional[bytes]:
+    """Re-encode MP3 speech as Opus in an OGG container, or return None if that fails.
+
+    gTTS only emits MP3. Transcoding needs ffmpeg on the host, so callers should
+    fall back to the MP3 when this returns None.
+    """
+    try:
+        audio = AudioSegment.from_mp3(BytesIO(mp3_bytes))
+        buf = BytesIO()
+        audio.export(buf, format="ogg", codec="libopus", bitrate=OPUS_BITRATE)
+    except Exception:
+        return None
+    return buf.getvalue()
+
+
+def browser_plays_opus() -> bool:
+    """Guess from the User-Agent whether the browser plays Ogg/Opus.
+
+    Safari and every iOS browser (all WebKit) are sent MP3, since WebKit only
+    plays Ogg from version 17 on; everything else gets the smaller Opus.
+    """
+    try:
+        user_agent = st.context.headers.get("User-Agent", "")
+    except Exception:
+        return True
+    if re.search(r"iPhone|iPad|iPod", user_agent):
+        return False
+    # Chromium-based browsers and Firefox also mention Safari in their User-Agent
+    return "Safari" not in user_agent or bool(re.search(r"Chrome|Chromium|Edg|Firefox|OPR", user_agent))
 
 
 # --------------------------
 # UI
 # --------------------------
+_warm_up_client()
 st.title("🌐 Multilingual Translator + Text-to-Speech (Gemini + gTTS)")
 st.write(
     "Translate English text into a target language using Google Gemini, then convert the result to speech with gTTS. "
@@ -200,27 +930,54 @@ with tab_file:
 
 # Decide what to translate
 to_process = None
+table = None
 if go_text:
     to_process = (input_text or "").strip()
 elif go_file and uploaded:
     try:
-        to_process = extract_text_from_file(uploaded).strip()
+        table = load_table(uploaded)
+        if table is None:
+            to_process = extract_text_from_file(uploaded).strip()
     except Exception as e:
         st.error(str(e))
 
-if to_process:
-    if not to_process.strip():
+if to_process or table is not None:
+    if table is None and not to_process.strip():
         st.warning("Please provide some English text.")
     else:
+        speech = None
         try:
             with st.spinner("Initializing model..."):
-                model = get_model()
-
-            with st.spinner(f"Translating to {target_name}..."):
-                translated = translate_text(model, to_process, target_name)
+                model = get_model(target_name)
 
             st.subheader("Translated Text")
-            st.text_area("Result", translated, height=220)
+            result_box = st.empty()
+            # Measured once here and handed to translate_text, so the text is only tokenized once
+            chunks = [] if table is not None else split_for_translation(model, to_process)
+            if table is not None:
+                with st.spinner(f"Translating table to {target_name}..."):
+                    translated = translate_table(model, table, target_name)
+            elif len(chunks) == 1:
+                # Single request: stream the translation and synthesize speech as sentences complete
+                speech = SpeechStream(tts_lang_code)
+                translated = ""
+                try:
+                    for piece in stream_translation(model, to_process, target_name):
+                        translated += piece
+                        speech.feed(piece)
+                        result_box.text(translated)
+                    translated = translated.strip()
+                except TranslationTruncated:
+                    # One request wasn't enough room; redo it in smaller chunks and speak that instead
+                    speech.close()
+                    speech = None
+                    with st.spinner(f"Translating to {target_name}..."):
+                        translated = translate_text(model, to_process, target_name, chunks)
+            else:
+                with st.spinner(f"Translating to {target_name}..."):
+                    translated = translate_text(model, to_process, target_name, chunks)
+
+            result_box.text_area("Result", translated, height=220)
 
             # Download translated text
             st.download_button(
@@ -231,20 +988,36 @@ if to_process:
             )
 
             # TTS
-            with st.spinner("Generating speech (MP3)..."):
-                mp3_path = synthesize_speech(translated, tts_lang_code)
-
-            with open(mp3_path, "rb") as f:
-                audio_bytes = f.read()
-
-            st.audio(audio_bytes, format="audio/mp3")
+            with st.spinner("Generating speech..."):
+                if speech is not None:
+                    audio_bytes = speech.finish()
+                else:
+                    audio_bytes = synthesize_speech(translated, tts_lang_code)
+                # One player: Opus where the browser plays it, otherwise the MP3 gTTS produced
+                opus_bytes = to_opus(audio_bytes) if browser_plays_opus() else None
+
+            if opus_bytes is not None:
+                st.audio(opus_bytes, format="audio/ogg")
+                st.download_button(
+                    "⬇️ Download Audio (Opus)",
+                    data=opus_bytes,
+                    file_name="translation.ogg",
+                    mime="audio/ogg",
+                )
+            else:
+                st.audio(audio_bytes, format="audio/mp3")
             st.download_button(
                 "⬇️ Download Audio (MP3)",
                 data=audio_bytes,
                 file_name="translation.mp3",
                 mime="audio/mpeg",
             )
+        except BatchPending as e:
+            st.info(str(e))
         except Exception as e:
             st.error(f"Error: {e}")
+        finally:
+            if speech is not None:
+                speech.close()
 else:
     st.caption("Tip: For large files, the app splits text into chunks to keep translations reliable.")
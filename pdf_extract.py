@@ -0,0 +1,52 @@
+"""PDF text extraction.
+
+Lives outside app.py so the page worker can be pickled by reference into
+ProcessPoolExecutor workers; functions defined in the Streamlit script can't be.
+"""
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import pymupdf
+
+# Starting a spawn pool (fresh interpreters that re-import pymupdf) takes ~1 s, while
+# extracting a text page takes ~1 ms, so the pool only pays off for very long documents
+PARALLEL_MIN_PAGES = 1000
+MAX_WORKERS = 4
+
+
+def _extract_pages(path: str, start: int, stop: int) -> List[str]:
+    with pymupdf.open(path) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
+
+
+def extract_pdf_text(data: bytes) -> str:
+    """Return the text of every page in the PDF, joined by blank lines.
+
+    Pages decode independently, so large documents are split into contiguous
+    page ranges and parsed in a process pool (one open per worker, not per page).
+    """
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        page_count = len(doc)
+        workers = min(os.cpu_count() or 1, MAX_WORKERS)
+        if page_count < PARALLEL_MIN_PAGES or workers < 2:
+            return "\n\n".join(page.get_text() for page in doc)
+
+    # Workers need a path to open; the upload only exists in memory.
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        step = -(-page_count // workers)  # ceil division
+        starts = list(range(0, page_count, step))
+        stops = [min(start + step, page_count) for start in starts]
+        # spawn, not fork: the Streamlit server is multi-threaded and holds live gRPC
+        # channels, and forking it can deadlock the children
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            ranges = pool.map(_extract_pages, [path] * len(starts), starts, stops)
+            return "\n\n".join(text for pages in ranges for text in pages)
+    finally:
+        os.remove(path)
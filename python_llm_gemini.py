@@ -32,19 +32,19 @@ def extract_text_from_file(uploaded_file):
     try:
         if uploaded_file.type == "application/pdf":
             reader = PyPDF2.PdfReader(uploaded_file)
-            text = ""
+            pages = []
             for page in reader.pages:
-                text += page.extract_text() + "\n"
-            return text.strip()
+                pages.append(page.extract_text() or "")
+            return "\n".join(pages).strip()
         elif uploaded_file.type == "text/plain":
             return str(uploaded_file.read(), "utf-8").strip()
         elif uploaded_file.type == "text/csv":
             df = pd.read_csv(uploaded_file)
-            return df.to_string(index=False)
+            return df.to_csv(index=False)
         elif uploaded_file.type in ["application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
                                     "application/vnd.ms-excel"]:
             df = pd.read_excel(uploaded_file)
-            return df.to_string(index=False)
+            return df.to_csv(index=False)
         else:
             return "Unsupported file type."
     except Exception as e: